@@ -0,0 +1,33 @@
+
+import os
+
+from starlette.applications import Starlette
+from starlette.responses import FileResponse, RedirectResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+from .server import iter_listing
+
+async def serve_path(request):
+    root = os.getcwd()
+    path = os.path.normpath(os.path.join(root, request.path_params['path']))
+    if path != root and not path.startswith(root + os.sep):
+        return Response(status_code=404)
+
+    if os.path.isdir(path):
+        # Same redirect http.server issues, clients always ask with a slash
+        if not request.url.path.endswith('/'):
+            return RedirectResponse(request.url.path + '/', status_code=301)
+        try:
+            dirents = os.scandir(path)
+        except OSError:
+            return Response(status_code=404)
+        return StreamingResponse(iter_listing(dirents),
+                                 media_type='application/json; charset=utf-8')
+
+    if os.path.isfile(path):
+        # Handles Range requests and uses sendfile where the server allows
+        return FileResponse(path)
+
+    return Response(status_code=404)
+
+app = Starlette(routes=[Route('/{path:path}', serve_path)])
@@ -0,0 +1,111 @@
+
+import mmap
+import os
+
+from collections import OrderedDict
+
+BLOCK_SIZE = 1 << 20
+
+class RangeCache:
+    '''LRU cache of file data, capped by total bytes
+
+    Holds fixed size blocks keyed by (inode, block index) and whole file
+    MemfdBuffers keyed by inode. Buffers held open by a handle are pinned
+    and never evicted, but still count against the cap.
+    '''
+
+    def __init__(self, max_bytes=256 << 20, block_size=BLOCK_SIZE):
+        self.block_size = block_size
+        self.max_bytes = max_bytes
+        self._size = 0
+        self._entries = OrderedDict()
+
+    def get(self, inode, index):
+        block = self._entries.get((inode, index))
+        if block is not None:
+            self._entries.move_to_end((inode, index))
+        return block
+
+    def put(self, inode, index, data):
+        self._insert((inode, index), data)
+
+    def open_buffer(self, inode, size):
+        '''Pin the MemfdBuffer for inode, creating it if needed'''
+        buf = self._entries.get(inode)
+        if buf is None or len(buf) != size:
+            buf = MemfdBuffer(size, self.block_size)
+            self._insert(inode, buf)
+        else:
+            self._entries.move_to_end(inode)
+        buf.pins += 1
+        return buf
+
+    def release_buffer(self, buf):
+        '''Unpin buf, it stays cached until evicted'''
+        buf.pins -= 1
+        if not buf.cached and not buf.pins:
+            buf.close()
+        self._evict()
+
+    def blocks(self, offset, length):
+        '''Block indices covering [offset, offset+length)'''
+        return range(offset // self.block_size,
+                     (offset + length - 1) // self.block_size + 1)
+
+    def _insert(self, key, value):
+        self._discard(key)
+        self._entries[key] = value
+        self._size += len(value)
+        self._evict(keep=key)
+
+    def _discard(self, key):
+        old = self._entries.pop(key, None)
+        if old is None:
+            return
+        self._size -= len(old)
+        if isinstance(old, MemfdBuffer):
+            # An open handle keeps using it, only the cache lets go
+            old.cached = False
+            if not old.pins:
+                old.close()
+
+    def _evict(self, keep=None):
+        # Always keep the entry just inserted, even if it alone exceeds the cap
+        for key in list(self._entries):
+            if self._size <= self.max_bytes:
+                break
+            if key == keep or getattr(self._entries[key], 'pins', 0):
+                continue
+            self._discard(key)
+
+class MemfdBuffer:
+    '''Anonymous RAM backed copy of a whole file, filled a block at a time'''
+
+    def __init__(self, size, block_size=BLOCK_SIZE):
+        self.block_size = block_size
+        self.pins = 0
+        self.cached = True
+        self._fd = os.memfd_create('pyhttpfs', os.MFD_CLOEXEC)
+        os.ftruncate(self._fd, size)
+        self._mmap = mmap.mmap(self._fd, size)
+        self._present = set()
+
+    def __len__(self):
+        return len(self._mmap)
+
+    def has(self, index):
+        return index in self._present
+
+    def put(self, first, last, data):
+        '''Store data read for blocks first through last'''
+        offset = first * self.block_size
+        n = min(len(data), len(self._mmap) - offset)
+        self._mmap[offset:offset + n] = data[:n]
+        self._present.update(range(first, last + 1))
+
+    def read(self, offset, length):
+        return self._mmap[offset:offset + length]
+
+    def close(self):
+        self._mmap.close()
+        os.close(self._fd)
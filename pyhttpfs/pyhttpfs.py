@@ -3,10 +3,11 @@
 pyhttpfs.py - use pyfuse3 to bind a simple http server to the filesystem
 '''
 
+import bisect
 import errno
 import faulthandler
 import httpx
-import json
+import ijson
 import logging
 import os
 import pyfuse3
@@ -16,39 +17,80 @@ import trio
 
 from argparse import ArgumentParser
 from collections import defaultdict
-from tempfile import TemporaryFile 
 
-from .types import File, Timestamp
+from .cache import RangeCache
+from .types import File, OpenHandle, Timestamp
 
 faulthandler.enable()
 log = logging.getLogger(__name__)
 
+CHUNK_SIZE = 1 << 20
+
+def _missing_runs(indices, present):
+    '''Group block indices that are not present into [first, last] runs'''
+    runs = []
+    for i in indices:
+        if present(i):
+            continue
+        if runs and runs[-1][1] == i - 1:
+            runs[-1][1] = i
+        else:
+            runs.append([i, i])
+    return runs
+
 class HttpFs(pyfuse3.Operations):
 
     enable_writeback_cache = True
 
-    def __init__(self, source):
+    def __init__(self, source, prefetch_depth=2, cache_size=256 << 20,
+                 attr_timeout=60.0, memfd_threshold=512 << 20):
         super(HttpFs, self).__init__()
 
         self._url = source
+        self._prefetch_depth = prefetch_depth
+        self._attr_timeout = attr_timeout
+        # Buffers count against the cache, a bigger one could never be kept
+        self._memfd_threshold = min(memfd_threshold, cache_size)
 
         mode = stat_m.S_IREAD | stat_m.S_IFDIR | stat_m.S_IRGRP | stat_m.S_IROTH
         self.root = File(path='/', inode=pyfuse3.ROOT_INODE, mode=mode, size=4096,
                          timestamp=Timestamp())
         self._inode_to_file_map = {  pyfuse3.ROOT_INODE: self.root }
-        self._inode_to_tmpfile_map = {}
-        self._fd_inode_map = dict()
-        self._fd_open_count = dict()
+        self._fd_map = dict()
+        self._cache = RangeCache(max_bytes=cache_size)
+        self._nursery = None
+        self._prefetching = set()
+
+        # Shared across all requests so connections are kept alive
+        self._client = httpx.AsyncClient(http2=True,
+                                         limits=httpx.Limits(max_connections=64,
+                                                             max_keepalive_connections=32),
+                                         timeout=httpx.Timeout(30.0))
 
         # Okay blocking for init
-        trio.run(self._load_children,self.root)
+        trio.run(self._prefetch_subtree, self.root, self._prefetch_depth)
 
-    async def async_get_json(self, url):
-        async with httpx.AsyncClient() as client:
-            response = await client.get(url, follow_redirects=True)
-            if not response.is_success:
-                raise(pyfuse3.FUSEError(errno.ENOENT))
-            return response.json()
+    async def aiter_json_array(self, url):
+        # Anything but FUSEError escaping readdir ends pyfuse3.main, and
+        # _load_children drops a partial listing, so report EIO instead
+        try:
+            async with self._client.stream('GET', url, follow_redirects=True) as response:
+                if not response.is_success:
+                    raise(pyfuse3.FUSEError(errno.ENOENT))
+                # ijson's push interface works with every backend under trio
+                items = ijson.sendable_list()
+                parser = ijson.items_coro(items, 'item', use_float=True)
+                async for chunk in response.aiter_bytes():
+                    parser.send(chunk)
+                    for item in items:
+                        yield item
+                    del items[:]
+                parser.close()
+                for item in items:
+                    yield item
+        except (httpx.HTTPError, ijson.JSONError) as e:
+            log.error('listing %s failed: %s', url, e)
+            raise pyfuse3.FUSEError(errno.EIO)
 
     async def lookup(self, inode_p, name, ctx=None):
         name = os.fsdecode(name)
@@ -59,12 +101,11 @@ class HttpFs(pyfuse3.Operations):
             if name == '.':
                 inode = inode_p
             elif name == '..':
-                inode = self._inode_to_file_map[inode_p]['parent'].l_inode()
+                inode = self._inode_to_file_map[inode_p].parent.l_inode()
             else:
-                for c in self._inode_to_file_map[inode_p]['children']:
-                    if name == c.basename():
-                        inode = c.l_inode()
-                        break
+                c = self._inode_to_file_map[inode_p].name_index.get(name)
+                if c is not None:
+                    inode = c.l_inode()
 
         except KeyError as e:
             raise(pyfuse3.FUSEError(errno.ENOENT))
@@ -81,25 +122,97 @@ class HttpFs(pyfuse3.Operations):
         if url[-1] != '/':
             url += '/'
 
-        for f in await self.async_get_json(url):
-            c = File.from_json(f)
-            c['parent'] = pobj
-            pobj.push_child(File.from_json(f))
+        # Entries are built while the listing is still arriving, but only
+        # attached once it is complete so a failed load leaves no trace
+        children = []
+        async for f in self.aiter_json_array(url):
+            try:
+                c = File.from_json(f)
+            except (KeyError, TypeError) as e:
+                log.error('bad entry listing %s: %s', url, e)
+                raise pyfuse3.FUSEError(errno.EIO)
+            c.parent = pobj
+            children.append(c)
+
+        # Another task may have loaded this directory while we waited
+        if pobj.walked:
+            return
+
+        for c in children:
+            pobj.push_child(c)
             self._inode_to_file_map[c.l_inode()] = c
+        pobj.walked = True
+
+    async def _prefetch_subtree(self, pobj, depth):
+        if not pobj.walked:
+            await self._load_children(pobj)
+        if depth > 0:
+            await self._prefetch_children(pobj, depth - 1)
+
+    async def _prefetch_children(self, pobj, depth):
+        async with trio.open_nursery() as nursery:
+            for c in pobj.children:
+                if c.is_dir():
+                    nursery.start_soon(self._try_prefetch_subtree, c, depth)
+
+    def _schedule_prefetch(self, pobj):
+        '''Load any cold subdirectories of pobj in the background'''
+        if self._nursery is None or pobj.l_inode() in self._prefetching:
+            return
+        if not any(c.is_dir() and not c.walked for c in pobj.children):
+            return
+
+        self._prefetching.add(pobj.l_inode())
+        self._nursery.start_soon(self._background_prefetch, pobj)
+
+    async def _background_prefetch(self, pobj):
+        try:
+            await self._prefetch_children(pobj, 0)
+        finally:
+            self._prefetching.discard(pobj.l_inode())
+
+    async def _try_prefetch_subtree(self, pobj, depth):
+        # Prefetching is best effort, the directory is loaded again on demand
+        try:
+            await self._prefetch_subtree(pobj, depth)
+        except Exception as e:
+            log.debug('prefetch of %s failed: %s', pobj.full_path(), e)
+
+    async def main(self):
+        '''Run the FUSE main loop with a nursery for background prefetches'''
+        async with trio.open_nursery() as nursery:
+            self._nursery = nursery
+            try:
+                await pyfuse3.main()
+            finally:
+                self._nursery = None
+                nursery.cancel_scope.cancel()
 
     async def getattr(self, inode, ctx=None):
         return self._getattr(self._inode_to_file_map[inode])
 
     def _getattr(self, fobj):
-        stat = fobj.stat()
+        if fobj._entry is None:
+            fobj._entry = self._build_entry(fobj)
+        return fobj._entry
+
+    def _build_entry(self, fobj):
+        ts = fobj.timestamp
         entry = pyfuse3.EntryAttributes()
-        for attr in ('st_ino', 'st_mode', 'st_nlink', 'st_uid', 'st_gid',
-                     'st_rdev', 'st_size', 'st_atime_ns', 'st_mtime_ns',
-                     'st_ctime_ns'):
-            setattr(entry, attr, getattr(stat, attr))
+        entry.st_ino = fobj.l_inode()
+        entry.st_mode = fobj.mode
+        entry.st_nlink = fobj.nlink
+        entry.st_uid = fobj.uid
+        entry.st_gid = fobj.gid
+        entry.st_rdev = fobj.dev
+        entry.st_size = fobj.size
+        entry.st_atime_ns = ts.atime_ns()
+        entry.st_mtime_ns = ts.mtime_ns()
+        entry.st_ctime_ns = ts.ctime_ns()
         entry.generation = 0
-        entry.entry_timeout = 0
-        entry.attr_timeout = 0
+        # Read-only mirror, let the kernel cache lookups and attributes
+        entry.entry_timeout = self._attr_timeout
+        entry.attr_timeout = self._attr_timeout
         entry.st_blksize = 512
         entry.st_blocks = ((entry.st_size+entry.st_blksize-1) // entry.st_blksize)
         return entry
@@ -113,23 +226,28 @@ class HttpFs(pyfuse3.Operations):
 
     async def readdir(self, inode, off, token):
         fobj = self._inode_to_file_map[inode]
-        if not fobj['walked']:
+        if not fobj.walked:
             await self._load_children(fobj)
-
-        path = fobj.basename()
-        log.debug('reading %s', path)
-        entries = []
-        for c in fobj['children']:
-            if c.basename() == '.' or c.basename() == '..':
-                continue
-            attr = self._getattr(c)
-            entries.append((attr.st_ino, c.basename(), attr))
-
-        log.debug('read %d entries, starting at %d', len(entries), off)
-
-        for (ino, name, attr) in sorted(entries):
-            if ino <= off:
-                continue
+        if off == 0:
+            self._schedule_prefetch(fobj)
+
+        # pyfuse3 answers READDIRPLUS through this handler, so the cached
+        # attributes handed to readdir_reply double as the lookup reply
+        if fobj._sorted_entries is None:
+            entries = []
+            for c in fobj.children:
+                if c.basename() == '.' or c.basename() == '..':
+                    continue
+                attr = self._getattr(c)
+                entries.append((attr.st_ino, c.basename(), attr))
+            fobj._sorted_entries = sorted(entries, key=lambda e: e[0])
+            fobj._inos = [e[0] for e in fobj._sorted_entries]
+
+        log.debug('reading %s, %d entries, starting at %d', fobj.basename(),
+                  len(fobj._inos), off)
+
+        start = bisect.bisect_right(fobj._inos, off)
+        for (ino, name, attr) in fobj._sorted_entries[start:]:
             if not pyfuse3.readdir_reply(
                 token, os.fsencode(name), attr, ino):
                 break
@@ -172,51 +290,98 @@ class HttpFs(pyfuse3.Operations):
         raise pyfuse3.FUSEError(errno.EINVAL)
 
     async def open(self, inode, flags, ctx):
-        if inode in self._inode_to_tmpfile_map.keys():
-            fd = self._inode_to_tmpfile_map[inode]
-            self._fd_open_count[fd.fileno()] += 1
-            return pyfuse3.FileInfo(fh=fd.fileno())
         assert flags & os.O_CREAT == 0
 
-        uri = self._url + self._inode_to_file_map[inode].full_path()
-        fd = TemporaryFile('w+b')
-
-        async with httpx.AsyncClient() as client:
-            async with client.stream('GET', uri) as response:
-                if not response.is_success:
-                    raise pyfuse3.FUSEError(errno.ENOENT)
-                async for chunk in response.aiter_bytes():
-                    fd.write(chunk)
-
-        fd.seek(0)
-        self._inode_to_tmpfile_map[inode] = fd
-        self._fd_inode_map[fd.fileno()] = inode
-        self._fd_open_count[fd.fileno()] = 1
-        return pyfuse3.FileInfo(fh=fd.fileno())
+        # Nothing is downloaded up front, reads fill blocks on demand
+        handle = self._fd_map.get(inode)
+        if handle is not None:
+            handle.refcount += 1
+            return pyfuse3.FileInfo(fh=inode)
+
+        # Smaller files are kept whole in a RAM buffer that stays cached
+        # after release, anything else is cached block by block
+        size = self._inode_to_file_map[inode].size
+        buf = None
+        if 0 < size <= self._memfd_threshold:
+            buf = self._cache.open_buffer(inode, size)
+        self._fd_map[inode] = OpenHandle(inode, buf)
+        return pyfuse3.FileInfo(fh=inode)
 
     async def create(self, inode_p, name, mode, flags, ctx):
         log.error('create not supported')
         raise pyfuse3.FUSEError(errno.EINVAL)
 
+    async def _fetch_range(self, fobj, start, end):
+        uri = self._url + fobj.full_path()
+        headers = { 'Range': f'bytes={start}-{end - 1}' }
+        data = bytearray()
+
+        # Network failures must surface as FUSEError, anything else ends
+        # pyfuse3.main and unmounts the filesystem
+        try:
+            async with self._client.stream('GET', uri, headers=headers) as response:
+                if not response.is_success:
+                    raise pyfuse3.FUSEError(errno.EIO)
+                # Servers without range support send the whole file
+                partial = response.status_code == 206
+                pos = start if partial else 0
+                async for chunk in response.aiter_bytes(chunk_size=CHUNK_SIZE):
+                    if pos + len(chunk) > start:
+                        data += chunk[max(start - pos, 0):end - pos]
+                    pos += len(chunk)
+                    # A 206 is read to the end so the connection returns to the pool
+                    if not partial and pos >= end:
+                        break
+        except httpx.HTTPError as e:
+            log.error('reading %s failed: %s', uri, e)
+            raise pyfuse3.FUSEError(errno.EIO)
+
+        return bytes(data)
+
     async def read(self, fd, offset, length):
-        os.lseek(fd, offset, os.SEEK_SET)
-        return os.read(fd, length)
+        handle = self._fd_map[fd]
+        fobj = self._inode_to_file_map[handle.inode]
+        length = min(length, fobj.size - offset)
+        if length <= 0:
+            return b''
+
+        bs = self._cache.block_size
+        indices = self._cache.blocks(offset, length)
+
+        # One range request per contiguous run of missing blocks
+        buf = handle.buffer
+        if buf is not None:
+            for first, last in _missing_runs(indices, buf.has):
+                data = await self._fetch_range(fobj, first * bs,
+                                               min((last + 1) * bs, fobj.size))
+                buf.put(first, last, data)
+            return buf.read(offset, length)
+
+        blocks = { i: self._cache.get(handle.inode, i) for i in indices }
+        for first, last in _missing_runs(indices, lambda i: blocks[i] is not None):
+            data = await self._fetch_range(fobj, first * bs,
+                                           min((last + 1) * bs, fobj.size))
+            for i in range(first, last + 1):
+                block = data[(i - first) * bs:(i - first + 1) * bs]
+                self._cache.put(handle.inode, i, block)
+                blocks[i] = block
+
+        start = offset - indices[0] * bs
+        return b''.join(blocks[i] for i in indices)[start:start + length]
 
     async def write(self, fd, offset, buf):
         log.error('write not supported')
         raise pyfuse3.FUSEError(errno.EINVAL)
 
     async def release(self, fd):
-        if self._fd_open_count[fd] > 1:
-            self._fd_open_count[fd] -= 1
+        handle = self._fd_map[fd]
+        handle.refcount -= 1
+        if handle.refcount:
             return
 
-        del self._fd_open_count[fd]
-
-        inode = self._fd_inode_map[fd]
-        self._inode_to_tmpfile_map[inode].close()
-        del self._inode_to_tmpfile_map[inode]
-        del self._fd_inode_map[fd]
+        del self._fd_map[fd]
+        if handle.buffer is not None:
+            self._cache.release_buffer(handle.buffer)
 
 def init_logging(debug=False):
     formatter = logging.Formatter('%(asctime)s.%(msecs)03d %(threadName)s: '
@@ -242,6 +407,15 @@ def parse_args(args):
                         help='URL where PyHTTPfs server is running')
     parser.add_argument('mountpoint', type=str,
                         help='Where to mount the file system')
+    parser.add_argument('--prefetch-depth', type=int, default=2,
+                        help='Directory levels to load concurrently at mount time')
+    parser.add_argument('--cache-size', type=int, default=256,
+                        help='Maximum MiB of file data to keep cached')
+    parser.add_argument('--attr-timeout', type=float, default=60.0,
+                        help='Seconds the kernel may cache entries and attributes')
+    parser.add_argument('--memfd-threshold', type=int, default=512,
+                        help='Keep files up to this many MiB whole in RAM, '
+                             'capped by --cache-size')
     parser.add_argument('--debug', action='store_true', default=False,
                         help='Enable debugging output')
     parser.add_argument('--debug-fuse', action='store_true', default=False,
@@ -252,7 +426,9 @@ def parse_args(args):
 def main():
     options = parse_args(sys.argv[1:])
     init_logging(options.debug)
-    httpfs = HttpFs(options.source)
+    httpfs = HttpFs(options.source, options.prefetch_depth,
+                    options.cache_size << 20, options.attr_timeout,
+                    options.memfd_threshold << 20)
 
     log.debug('Mounting...')
     fuse_options = set(pyfuse3.default_options)
@@ -264,10 +440,12 @@ def main():
 
     try:
         log.debug('Entering main loop..')
-        trio.run(pyfuse3.main)
+        trio.run(httpfs.main)
     except:
         pyfuse3.close(unmount=True)
         raise
+    finally:
+        trio.run(httpfs._client.aclose)
 
     log.debug('Unmounting..')
     pyfuse3.close()
@@ -1,19 +1,170 @@
 
 import http.server
 import io
-import json
+import orjson
 import os
-import socketserver
+import signal
+import socket
 import stat
 import sys
 
 from argparse import ArgumentParser
-from datetime import datetime
 
 from .types import File, Timestamp
 
+CHUNK_SIZE = 1 << 16
+SENDFILE_SIZE = 1 << 20
+
+def parse_range(header, size):
+    '''Parse a single "bytes=" range into [start, end), None if unusable'''
+    unit, _, spec = header.partition('=')
+    if unit.strip() != 'bytes' or ',' in spec:
+        return None
+
+    first, sep, last = spec.strip().partition('-')
+    if not sep:
+        return None
+
+    try:
+        if not first:
+            # Suffix range, the last N bytes
+            return max(size - int(last), 0), size
+        start = int(first)
+        if last and int(last) < start:
+            return None
+        end = min(int(last) + 1, size) if last else size
+    except ValueError:
+        return None
+
+    return start, end
+
+def iter_listing(dirents):
+    '''Yield a directory listing as a JSON array, batched into chunks'''
+    buf = bytearray(b'[')
+    sep = b''
+    with dirents:
+        for dirent in dirents:
+            # Headers are already sent, so one bad entry must not end the body
+            try:
+                st = dirent.stat()
+            except OSError:
+                try:
+                    st = dirent.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+            t = Timestamp.from_ns(mtime_ns=st.st_mtime_ns,
+                                  atime_ns=st.st_atime_ns,
+                                  ctime_ns=st.st_ctime_ns)
+            f = File(dirent.name, dev=st.st_dev, inode=st.st_ino,
+                mode=st.st_mode, nlink=st.st_nlink, uid=st.st_uid,
+                gid=st.st_gid, size=st.st_size, timestamp=t)
+            buf += sep + orjson.dumps(f.to_json())
+            sep = b','
+            if len(buf) >= CHUNK_SIZE:
+                yield bytes(buf)
+                buf = bytearray()
+    buf += b']'
+    yield bytes(buf)
+
 class FsServer(http.server.SimpleHTTPRequestHandler):
 
+    # Chunked transfer encoding (and keep-alive) need HTTP/1.1
+    protocol_version = 'HTTP/1.1'
+    server_version = 'PyHttpFS/1.0'
+
+    def send_head(self):
+        self._remaining = None
+        rng = self.headers.get('Range')
+        path = self.translate_path(self.path)
+        if rng is None or self.path.endswith('/') or not os.path.isfile(path):
+            return super().send_head()
+
+        try:
+            f = open(path, 'rb')
+        except OSError:
+            self.send_error(404, "File not found")
+            return None
+
+        try:
+            fs = os.fstat(f.fileno())
+            r = parse_range(rng, fs.st_size)
+            if r is None:
+                f.close()
+                return super().send_head()
+
+            start, end = r
+            if start >= fs.st_size:
+                f.close()
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{fs.st_size}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return None
+
+            self.send_response(206)
+            self.send_header('Content-type', self.guess_type(path))
+            self.send_header('Content-Range', f'bytes {start}-{end - 1}/{fs.st_size}')
+            self.send_header('Content-Length', str(end - start))
+            self.send_header('Last-Modified', self.date_time_string(fs.st_mtime))
+            self.send_header('Accept-Ranges', 'bytes')
+            self.end_headers()
+            f.seek(start)
+            self._remaining = end - start
+            return f
+        except:
+            f.close()
+            raise
+
+    def copyfile(self, source, outputfile):
+        offset = source.tell()
+        remaining = self._remaining
+        if remaining is None:
+            remaining = os.fstat(source.fileno()).st_size - offset
+
+        if self.server.uring is not None:
+            remaining = self._copy_uring(source, outputfile, offset, remaining)
+        else:
+            remaining = self._copy_sendfile(source, outputfile, offset, remaining)
+
+        if remaining > 0:
+            # File shrank underneath us, Content-Length can't be honoured
+            self.close_connection = True
+
+    def _copy_sendfile(self, source, outputfile, offset, remaining):
+        try:
+            sent = os.sendfile(outputfile.fileno(), source.fileno(), offset,
+                               min(remaining, SENDFILE_SIZE))
+        except (OSError, AttributeError, io.UnsupportedOperation):
+            # Not a regular file or not a real socket, copy through userspace
+            while remaining > 0:
+                buf = source.read(min(remaining, SENDFILE_SIZE))
+                if not buf:
+                    break
+                outputfile.write(buf)
+                remaining -= len(buf)
+        else:
+            while sent and remaining - sent > 0:
+                offset += sent
+                remaining -= sent
+                sent = os.sendfile(outputfile.fileno(), source.fileno(), offset,
+                                   min(remaining, SENDFILE_SIZE))
+            remaining -= sent
+        return remaining
+
+    def _copy_uring(self, source, outputfile, offset, remaining):
+        buf = bytearray(min(remaining, SENDFILE_SIZE))
+        while remaining > 0:
+            n = min(self.server.uring.read(source.fileno(), buf, offset), remaining)
+            if not n:
+                break
+            outputfile.write(memoryview(buf)[:n])
+            offset += n
+            remaining -= n
+        return remaining
+
+    def _write_chunk(self, data):
+        self.wfile.write(b'%x\r\n' % len(data) + data + b'\r\n')
+
     def list_directory(self, path):
         try:
             dirents = os.scandir(path)
@@ -22,28 +173,27 @@ class FsServer(http.server.SimpleHTTPRequestHandler):
             return
 
         self.send_response(200)
+        self.send_header('Content-type', 'application/json; charset=utf-8')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
 
-        tab = []
-        for dirent in dirents:
-            st = dirent.stat()
-            ts = datetime.fromtimestamp(st.st_mtime)
-            t = Timestamp(mtim_sec=st.st_mtime,
-                          atim_sec=st.st_atime,
-                          ctim_sec=st.st_ctime)
-            f = File(dirent.name, dev=st.st_dev, inode=st.st_ino,
-                mode=st.st_mode, nlink=st.st_nlink, uid=st.st_uid,
-                gid=st.st_gid, size=st.st_size, timestamp=t)
-            tab.append(f)
+        if self.command == 'HEAD':
+            dirents.close()
+            return
 
-        output = json.dumps(tab, indent=4).encode()
+        for chunk in iter_listing(dirents):
+            self._write_chunk(chunk)
+        self.wfile.write(b'0\r\n\r\n')
 
-        headers = f'''HTTP/1.0 200 OK
-Server: PyHttpFS/1.0 Python/3.10.6
-Content-type: application/json; charset=utf-8
-Content-Length: {len(output)}'''
-        response = headers.encode() + b'\r\n\r\n' + output
+class FsHttpServer(http.server.ThreadingHTTPServer):
 
-        return io.BytesIO(response)
+    daemon_threads = True
+    uring = None
+
+    def server_bind(self):
+        # Lets several worker processes accept on the same port
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
 
 desc = '''Binds port (default 8000), and serves DIR (default .) to pyhttpfs clients'''
 epi = '''NOT FOR PRODUCTION USE: Does not implement any authentication, and
@@ -56,19 +206,59 @@ def parse_args(args):
 
     parser.add_argument('-d', '--dir', type=str, default='.',
                         help='Directory to serve')
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count(),
+                        help='Number of server processes')
+    parser.add_argument('--uring', action='store_true', default=False,
+                        help='Read files through io_uring instead of sendfile')
+    parser.add_argument('--asgi', action='store_true', default=False,
+                        help='Serve with uvicorn instead of http.server')
     parser.add_argument('port', type=int, default=8000,
                         help='Port to bind for server')
     return parser.parse_args(args)
 
-def main():
-    options = parse_args(sys.argv[1:])
-    os.chdir(options.dir)
-    with socketserver.TCPServer(('', options.port), FsServer) as httpd:
+def serve(port, use_uring=False):
+    with FsHttpServer(('', port), FsServer) as httpd:
+        if use_uring:
+            # Each worker needs its own ring, so this happens after fork
+            from .uring import UringReadEngine
+            httpd.uring = UringReadEngine()
         try:
-            print("serving at port", options.port)
             httpd.serve_forever()
         except KeyboardInterrupt as e:
             httpd.shutdown()
+        finally:
+            if httpd.uring is not None:
+                httpd.uring.close()
+
+def main():
+    options = parse_args(sys.argv[1:])
+    os.chdir(options.dir)
+
+    if options.asgi:
+        import uvicorn
+        print("serving at port", options.port)
+        uvicorn.run('pyhttpfs.asgi:app', host='0.0.0.0', port=options.port,
+                    workers=options.workers)
+        return
+
+    workers = []
+    for _ in range(options.workers - 1):
+        pid = os.fork()
+        if pid == 0:
+            serve(options.port, options.uring)
+            os._exit(0)
+        workers.append(pid)
+
+    # Make sure workers are torn down with the parent
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    print("serving at port", options.port)
+    try:
+        serve(options.port, options.uring)
+    finally:
+        for pid in workers:
+            os.kill(pid, signal.SIGTERM)
+            os.waitpid(pid, 0)
     
 if __name__ == '__main__':
     main()
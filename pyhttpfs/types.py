@@ -4,27 +4,59 @@ import stat
 
 from datetime import datetime
 
-class Timestamp(dict):
+class Timestamp:
+    __slots__ = ('_mtime_ns', '_atime_ns', '_ctime_ns')
+
     def __init__(self, mtim_sec=0,
                        mtim_usec=0,
                        atim_sec=0,
                        atim_usec=0,
                        ctim_sec=0,
                        ctim_usec=0):
-        
-        self.mtime = datetime.fromtimestamp(mtim_sec + (mtim_usec / 1000000000))
-        self.atime = datetime.fromtimestamp(atim_sec + (atim_usec / 1000000000))
-        self.ctime = datetime.fromtimestamp(ctim_sec + (ctim_usec / 1000000000))
 
-        dict.__init__(self, mtime = self.mtime.isoformat(),
-                            atime = self.atime.isoformat(),
-                            ctime = self.ctime.isoformat())
+        self._set_ns(int(mtim_sec * 1000000000) + int(mtim_usec * 1000),
+                     int(atim_sec * 1000000000) + int(atim_usec * 1000),
+                     int(ctim_sec * 1000000000) + int(ctim_usec * 1000))
+
+    def _set_ns(self, mtime_ns, atime_ns, ctime_ns):
+        self._mtime_ns = mtime_ns
+        self._atime_ns = atime_ns
+        self._ctime_ns = ctime_ns
+
+    @classmethod
+    def from_ns(cls, mtime_ns=0, atime_ns=0, ctime_ns=0):
+        ts = cls.__new__(cls)
+        ts._set_ns(mtime_ns, atime_ns, ctime_ns)
+        return ts
 
     @classmethod
     def from_json(cls, json_data):
-        return cls(mtim_sec=datetime.fromisoformat(json_data['mtime']).timestamp(),
-                   atim_sec=datetime.fromisoformat(json_data['atime']).timestamp(),
-                   ctim_sec=datetime.fromisoformat(json_data['ctime']).timestamp())
+        try:
+            return cls.from_ns(mtime_ns=json_data['mtime_ns'],
+                               atime_ns=json_data['atime_ns'],
+                               ctime_ns=json_data['ctime_ns'])
+        except KeyError:
+            # Older servers send ISO formatted strings
+            return cls(mtim_sec=datetime.fromisoformat(json_data['mtime']).timestamp(),
+                       atim_sec=datetime.fromisoformat(json_data['atime']).timestamp(),
+                       ctim_sec=datetime.fromisoformat(json_data['ctime']).timestamp())
+
+    def to_json(self):
+        return { 'mtime_ns': self._mtime_ns,
+                 'atime_ns': self._atime_ns,
+                 'ctime_ns': self._ctime_ns }
+
+    @property
+    def mtime(self):
+        return datetime.fromtimestamp(self._mtime_ns / 1000000000)
+
+    @property
+    def atime(self):
+        return datetime.fromtimestamp(self._atime_ns / 1000000000)
+
+    @property
+    def ctime(self):
+        return datetime.fromtimestamp(self._ctime_ns / 1000000000)
 
     def __str__(self):
         return str(self.mtime)
@@ -33,21 +65,20 @@ class Timestamp(dict):
         return "%s %s %s" % (str(self.mtime), str(self.atime), str(self.ctime))
 
     def mtime_ns(self):
-        return Timestamp._to_ns(self.mtime)
+        return self._mtime_ns
 
     def atime_ns(self):
-        return Timestamp._to_ns(self.atime)
+        return self._atime_ns
 
     def ctime_ns(self):
-        return Timestamp._to_ns(self.ctime)
+        return self._ctime_ns
 
-    @classmethod
-    def _to_ns(cls, ts):
-        if not type(ts) == datetime:
-            raise TypeError()
-        return ts.timestamp() * 1000000000
+class File:
+    __slots__ = ('path', 'dev', 'inode', 'mode', 'nlink', 'uid', 'gid', 'size',
+                 'timestamp', 'children', 'parent', 'walked', 'name_index',
+                 '_basename', '_sorted_entries', '_inos', '_entry',
+                 '_full_path')
 
-class File(dict):
     def __init__(self, path,
                        dev=1, # non-zero for pseudo-local-inode calc
                        inode=0,
@@ -57,23 +88,40 @@ class File(dict):
                        gid=0,
                        size=0,
                        timestamp=None,
-                       children=[],
+                       children=None,
                        parent=None,
                        walked=False):
 
-        dict.__init__(self, 
-                      st_path   = path,
-                      st_dev    = dev,
-                      st_inode  = inode,
-                      st_mode   = mode,
-                      st_nlink  = nlink,
-                      st_uid    = uid,
-                      st_gid    = gid,
-                      st_size   = size,
-                      timestamp = timestamp,
-                      children  = children,
-                      parent    = parent,
-                      walked    = walked)
+        self.path = path
+        self.dev = dev
+        self.inode = inode
+        self.mode = mode
+        self.nlink = nlink
+        self.uid = uid
+        self.gid = gid
+        self.size = size
+        self.timestamp = timestamp
+        self.children = children if children is not None else []
+        self.parent = parent
+        self.walked = walked
+        self.name_index = {}
+
+        self._basename = os.path.basename(path)
+        self._sorted_entries = None
+        self._inos = None
+        self._entry = None
+        self._full_path = None
+
+    def to_json(self):
+        return { 'st_path': self.path,
+                 'st_dev': self.dev,
+                 'st_inode': self.inode,
+                 'st_mode': self.mode,
+                 'st_nlink': self.nlink,
+                 'st_uid': self.uid,
+                 'st_gid': self.gid,
+                 'st_size': self.size,
+                 'timestamp': self.timestamp.to_json() }
 
     @classmethod
     def from_json(cls, json_data):
@@ -85,73 +133,72 @@ class File(dict):
                    uid = json_data['st_uid'],
                    gid = json_data['st_gid'],
                    size = json_data['st_size'],
-                   timestamp = Timestamp.from_json(json_data['timestamp']),
-                   children = json_data['children'],
-                   parent = json_data['parent'],
-                   walked = json_data['walked'])
-
-    def stat(self):
-        ent = type('', (), {})()
-        setattr(ent, 'st_ino', self.l_inode())
-        setattr(ent, 'st_mode', self['st_mode'])
-        setattr(ent, 'st_nlink', self['st_nlink'])
-        setattr(ent, 'st_uid', self['st_uid'])
-        setattr(ent, 'st_gid', self['st_gid'])
-        setattr(ent, 'st_rdev', self['st_dev'])
-        setattr(ent, 'st_size', self['st_size'])
-        setattr(ent, 'st_atime_ns', self['timestamp'].atime_ns())
-        setattr(ent, 'st_mtime_ns', self['timestamp'].mtime_ns())
-        setattr(ent, 'st_ctime_ns', self['timestamp'].ctime_ns())
-        return ent
+                   timestamp = Timestamp.from_json(json_data['timestamp']))
 
     def basename(self):
-        return os.path.basename(self['st_path'])
+        return self._basename
 
     def l_inode(self):
-        return self['st_dev'] * self['st_inode']
+        return self.dev * self.inode
 
     def full_path(self):
-        if not self['parent']:
+        if self._full_path is not None:
+            return self._full_path
+
+        if not self.parent:
             return '/'
 
-        parent = self['parent'].full_path()
+        parent = self.parent.full_path()
         if parent != '/':
             parent += '/'
-        return parent + self['st_path']
+        self._full_path = parent + self.path
+        return self._full_path
 
     def push_child(self, c):
-        self['walked'] = True
-        self['children'].append(c)
+        self.walked = True
+        self._sorted_entries = None
+        self._inos = None
+        c._full_path = self.full_path().rstrip('/') + '/' + c.path
+        self.children.append(c)
+        self.name_index[c.basename()] = c
 
-    def mode(self):
-        return stat.filemode(self['st_mode'])
+    def filemode(self):
+        return stat.filemode(self.mode)
 
     def is_dir(self):
-        return stat.S_ISDIR(self['st_mode'])
+        return stat.S_ISDIR(self.mode)
 
     def is_block(self):
-        return stat.S_ISBLK(self['st_mode'])
+        return stat.S_ISBLK(self.mode)
 
     def is_char(self):
-        return stat.S_ISCHR(self['st_mode'])
+        return stat.S_ISCHR(self.mode)
 
     def is_door(self):
-        return stat.S_ISDOOR(self['st_mode'])
+        return stat.S_ISDOOR(self.mode)
 
     def is_fifo(self):
-        return stat.S_ISFIFO(self['st_mode'])
+        return stat.S_ISFIFO(self.mode)
 
     def is_link(self):
-        return stat.S_ISLNK(self['st_mode'])
+        return stat.S_ISLNK(self.mode)
 
     def is_port(self):
-        return stat.S_ISPORT(self['st_mode'])
+        return stat.S_ISPORT(self.mode)
 
     def is_regular(self):
-        return stat.S_ISREG(self['st_mode'])
+        return stat.S_ISREG(self.mode)
 
     def is_sock(self):
-        return stat.S_ISSOCK(self['st_mode'])
+        return stat.S_ISSOCK(self.mode)
 
     def is_whiteout(self):
-        return stat.S_ISWHT(self['st_mode'])
+        return stat.S_ISWHT(self.mode)
+
+class OpenHandle:
+    __slots__ = ('inode', 'buffer', 'refcount')
+
+    def __init__(self, inode, buffer=None):
+        self.inode = inode
+        self.buffer = buffer
+        self.refcount = 1
@@ -0,0 +1,77 @@
+
+import queue
+import threading
+
+import liburing
+
+class _ReadOp:
+    __slots__ = ('fd', 'buf', 'offset', 'result', 'done')
+
+    def __init__(self, fd, buf, offset):
+        self.fd = fd
+        self.buf = buf
+        self.offset = offset
+        self.result = 0
+        self.done = threading.Event()
+
+class UringReadEngine:
+    '''Batches reads from concurrent request threads onto one io_uring'''
+
+    def __init__(self, entries=256):
+        self._entries = entries
+        self._ring = liburing.Ring()
+        self._cqe = liburing.Cqe()
+        liburing.io_uring_queue_init(entries, self._ring)
+
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def read(self, fd, buf, offset):
+        '''Read into buf from fd at offset, returns the byte count'''
+        op = _ReadOp(fd, buf, offset)
+        self._queue.put(op)
+        op.done.wait()
+        if isinstance(op.result, OSError):
+            raise op.result
+        return op.result
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        liburing.io_uring_queue_exit(self._ring)
+
+    def _run(self):
+        while True:
+            # Block for one op, then take whatever else is already waiting
+            ops = [self._queue.get()]
+            while len(ops) < self._entries:
+                try:
+                    ops.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            stop = None in ops
+            ops = [op for op in ops if op is not None]
+
+            for i, op in enumerate(ops):
+                sqe = liburing.io_uring_get_sqe(self._ring)
+                liburing.io_uring_prep_read(sqe, op.fd, op.buf, op.offset)
+                liburing.io_uring_sqe_set_data64(sqe, i)
+            if ops:
+                liburing.io_uring_submit(self._ring)
+
+            for _ in ops:
+                liburing.io_uring_wait_cqe(self._ring, self._cqe)
+                cqe = self._cqe[0]
+                op = ops[liburing.io_uring_cqe_get_data64(cqe)]
+                # Cqe.res raises for a negative result rather than returning it
+                try:
+                    op.result = cqe.res
+                except OSError as e:
+                    op.result = e
+                liburing.io_uring_cqe_seen(self._ring, cqe)
+                op.done.set()
+
+            if stop:
+                return
@@ -9,10 +9,16 @@ setup(name='pyhttpfs',
       author='Paul Jordan',
       author_email='paullj1@gmail.com',
       packages=['pyhttpfs'],
-      dependencies=[
-          'httpx',
+      install_requires=[
+          'httpx[http2]',
+          'ijson',
+          'orjson',
           'pyfuse3'
       ],
+      extras_require={
+          'uring': ['liburing==2026.3.30'],
+          'asgi': ['starlette>=0.39', 'uvicorn[standard]'],
+      },
       entry_points = {
           'console_scripts': [
               'pyhttpfs=pyhttpfs.pyhttpfs:main',